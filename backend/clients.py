@@ -0,0 +1,60 @@
+import os
+import boto3
+import requests
+from botocore.config import Config
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared S3 / HTTP clients for the data scripts (imported with backend/ on sys.path).
+# Deliberately free of the DB layer, so S3-only tools don't pull in SQLAlchemy; use models.get_engine().
+# Module-level singletons are built once at import, so load .env first.
+load_dotenv(".env")
+
+# S3 / Railway Object Store Configuration
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+S3_REGION_NAME = os.getenv("S3_REGION_NAME", "us-east-1") # Default region if not specified
+
+def build_s3_client(max_attempts=10):
+    """
+    Creates a new S3 client. Prefer S3_CLIENT unless a process needs its own (e.g. after fork),
+    or fewer retries: interactive tools should fail fast on a bad endpoint.
+    """
+    return boto3.client(
+        's3',
+        aws_access_key_id=S3_ACCESS_KEY_ID,
+        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+        endpoint_url=S3_ENDPOINT_URL,
+        region_name=S3_REGION_NAME,
+        config=Config(
+            signature_version='s3v4',
+            s3={'addressing_style': 'path'},
+            # Enough pooled connections for concurrent multipart parts
+            max_pool_connections=50,
+            retries={'max_attempts': max_attempts, 'mode': 'adaptive'}
+        )
+    )
+
+# Fail fast when a host is unreachable (just over the 3 s TCP retransmit window);
+# read timeouts are per socket read and set by each caller
+HTTP_CONNECT_TIMEOUT = 3.05
+# Stream downloads in 1 MiB chunks; 8 KiB chunks make the Python loop the bottleneck on multi-MB MP3s
+HTTP_CHUNK = 1 << 20
+
+def build_http_session():
+    """requests.Session with pooled keep-alive connections and exponential-backoff retries."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# boto3 clients are thread-safe, but not fork-safe: child processes should call build_s3_client()
+S3_CLIENT = build_s3_client()
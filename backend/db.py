@@ -0,0 +1,53 @@
+from typing import AsyncGenerator
+import os
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from .models import Base, SCHEMA_UPGRADES
+
+def _async_url(url):
+    # asyncpg driver; accept Railway's postgres:// scheme as well
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return url.replace(prefix, "postgresql+asyncpg://", 1)
+    return url
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# One engine (and pool) for the whole API process, shared by every request
+engine = create_async_engine(
+    _async_url(DATABASE_URL),
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=1800  # Recycle before Railway's proxy drops idle connections
+) if DATABASE_URL else None
+
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False) if engine else None
+
+async def init_db():
+    if not engine:
+        print("DATABASE_URL not set. Skipping DB init.")
+        return
+
+    # Create extension if not exists (requires superuser)
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+    except Exception as e:
+        print(f"Could not create vector extension (might need superuser): {e}")
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
+    print("Database tables created.")
+
+async def get_session() -> AsyncGenerator[AsyncSession, None]:
+    """FastAPI dependency yielding a pooled async session."""
+    if not SessionLocal:
+        raise HTTPException(status_code=503, detail="Database not configured")
+    async with SessionLocal() as session:
+        yield session
@@ -1,14 +1,16 @@
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 import os
-from .models import init_db
+from .db import engine, init_db
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Initialize DB on startup
     print("Startup: Initializing Database...")
-    init_db()
+    await init_db()
     yield
+    if engine:
+        await engine.dispose()
 
 app = FastAPI(title="Text2Tracks API", lifespan=lifespan)
 
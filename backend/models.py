@@ -1,7 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, text
+from sqlalchemy import create_engine, Column, DateTime, Integer, String, Text, text
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.dialects.postgresql import JSONB
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC
 import os
 
 Base = declarative_base()
@@ -14,22 +14,96 @@ class Track(Base):
     artist = Column(Text)
     tags = Column(JSONB)
     audio_url = Column(Text)
-    # Using 512 dimensions for CLAP embeddings
-    embedding = Column(Vector(512))
+    # Using 512 dimensions for CLAP embeddings, stored as FP16 (halfvec, pgvector 0.7+)
+    embedding = Column(HALFVEC(512))
     semantic_id = Column(Text)
+    # Object key in the S3 bucket, so the worker can presign without parsing audio_url
+    s3_key = Column(Text)
+    # Vector worker queue state: NULL (pending) -> 'processing' -> 'done' | 'error'
+    embedding_status = Column(Text)
+    embedding_claimed_at = Column(DateTime(timezone=True))
+    # Failed inference attempts; the worker parks a track as 'error' after too many
+    embedding_attempts = Column(Integer, nullable=False, server_default=text("0"))
+
+# Idempotent DDL run after create_all, for columns and indexes added since the
+# tables were first created (create_all never alters existing tables)
+SCHEMA_UPGRADES = [
+    "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS s3_key TEXT",
+    "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS embedding_status TEXT",
+    "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS embedding_claimed_at TIMESTAMPTZ",
+    "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS embedding_attempts INTEGER NOT NULL DEFAULT 0",
+    # Keeps the worker's claim query cheap once most tracks are embedded
+    "CREATE INDEX IF NOT EXISTS tracks_pending_embedding ON tracks (id) WHERE embedding IS NULL",
+    # Convert FP32 vector(512) embeddings to halfvec(512); the old index uses vector ops
+    """
+    DO $$
+    BEGIN
+        IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'tracks'::regclass AND attname = 'embedding') <> 'halfvec(512)' THEN
+            DROP INDEX IF EXISTS tracks_embedding_hnsw;
+            ALTER TABLE tracks ALTER COLUMN embedding TYPE halfvec(512);
+        END IF;
+    END
+    $$
+    """,
+    # HNSW index for cosine similarity search (CLAP embeddings are L2-normalized)
+    "CREATE INDEX IF NOT EXISTS tracks_embedding_hnsw ON tracks "
+    "USING hnsw (embedding halfvec_cosine_ops) WITH (m = 16, ef_construction = 64)",
+]
+
+# NOTIFY channel the ingester signals after committing new tracks; the vector worker LISTENs on it
+NEW_TRACK_CHANNEL = "new_track"
+# Payload is the number of tracks in the committed batch
+NOTIFY_NEW_TRACKS = text(f"SELECT pg_notify('{NEW_TRACK_CHANNEL}', :count)")
+
+# Candidate list size for HNSW queries; higher improves recall at the cost of latency
+HNSW_EF_SEARCH = 40
+SET_HNSW_EF_SEARCH = text("SELECT set_config('hnsw.ef_search', :ef_search, true)")
+
+def set_hnsw_ef_search(session, ef_search=HNSW_EF_SEARCH):
+    """
+    Set hnsw.ef_search for the current transaction, before running a similarity query.
+    Works with AsyncSession too (await the result).
+    """
+    return session.execute(SET_HNSW_EF_SEARCH, {"ef_search": str(ef_search)})
+
+def _normalize_url(url):
+    # SQLAlchemy 1.4+ requires postgresql:// scheme; pin the psycopg2 driver we ship
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return url.replace(prefix, "postgresql+psycopg2://", 1)
+    return url
+
+# Process-wide engine and session factory, created on first use so that callers
+# can load .env after importing this module
+_ENGINE = None
+_SESSION_FACTORY = None
+
+def get_engine():
+    global _ENGINE, _SESSION_FACTORY
+    if _ENGINE is None:
+        DATABASE_URL = os.getenv("DATABASE_URL")
+        if not DATABASE_URL:
+            return None
+        _ENGINE = create_engine(
+            _normalize_url(DATABASE_URL),
+            pool_size=10,
+            max_overflow=5,
+            pool_pre_ping=True,
+            pool_recycle=1800,  # Recycle before Railway's proxy drops idle connections
+            # Batch UPDATE executemany calls through psycopg2's execute_batch instead of one round trip per row
+            executemany_mode="values_plus_batch"
+        )
+        # Sessions are short-lived; don't expire (and re-SELECT) loaded objects on commit
+        _SESSION_FACTORY = sessionmaker(bind=_ENGINE, expire_on_commit=False)
+    return _ENGINE
 
 def init_db():
-    DATABASE_URL = os.getenv("DATABASE_URL")
-    if not DATABASE_URL:
+    engine = get_engine()
+    if not engine:
         print("DATABASE_URL not set. Skipping DB init.")
         return
     
-    # SQLAlchemy 1.4+ requires postgresql:// scheme
-    if DATABASE_URL.startswith("postgres://"):
-        DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-        
-    engine = create_engine(DATABASE_URL)
-    
     # Create extension if not exists (requires superuser)
     try:
         with engine.connect() as conn:
@@ -39,21 +113,15 @@ def init_db():
         print(f"Could not create vector extension (might need superuser): {e}")
 
     Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for statement in SCHEMA_UPGRADES:
+            conn.execute(text(statement))
     print("Database tables created.")
 
 def get_db_session():
-    DATABASE_URL = os.getenv("DATABASE_URL")
-    if not DATABASE_URL:
+    if not get_engine():
         return None
-        
-    # SQLAlchemy 1.4+ requires postgresql:// scheme
-    url = DATABASE_URL
-    if url.startswith("postgres://"):
-        url = url.replace("postgres://", "postgresql://", 1)
-        
-    engine = create_engine(url)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    return _SESSION_FACTORY()
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
@@ -1,22 +1,28 @@
 import os
-import time
+import io
+import json
 import argparse
 import logging
-import requests
 import pandas as pd
-import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import NoCredentialsError
 from dotenv import load_dotenv
 from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Add backend to path to import models
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '../backend'))
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import sessionmaker
-from models import Track, Base, init_db, get_db_session
+from models import Track, Base, init_db, get_db_session, NOTIFY_NEW_TRACKS
+from clients import (
+    S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL, S3_BUCKET_NAME,
+    S3_CLIENT, HTTP_CHUNK, HTTP_CONNECT_TIMEOUT, build_s3_client, build_http_session
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,7 +30,6 @@ logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv(".env")
-load_dotenv(".env")
 # Debug: Print which keys are present (without values)
 required_keys = ["S3_ACCESS_KEY_ID", "S3_SECRET_ACCESS_KEY", "S3_ENDPOINT_URL", "S3_BUCKET_NAME", "DATABASE_URL"]
 missing_keys = [k for k in required_keys if not os.getenv(k)]
@@ -33,46 +38,45 @@ if missing_keys:
 else:
     print("All required environment variables found.", flush=True)
 
-# S3 / Railway Object Store Configuration
-S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
-S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
-S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-S3_REGION_NAME = os.getenv("S3_REGION_NAME", "us-east-1") # Default region if not specified
+# One session per process; worker processes inherit it before any connection is opened
+HTTP_SESSION = build_http_session()
 
-# DB Configuration
-DATABASE_URL = os.getenv("DATABASE_URL")
+# Multipart uploads with parallel parts; files under the threshold still go as a single PUT
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
 
-def get_s3_client():
-    return boto3.client(
-        's3',
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-        endpoint_url=S3_ENDPOINT_URL,
-        region_name=S3_REGION_NAME
-    )
+# Dataset TSV is streamed in chunks of this many rows, parsing only the columns we use
+TSV_CHUNK_ROWS = 10_000
+DATASET_COLUMNS = {'TRACK_ID', 'track_id', 'id', 'PATH', 'audio_url', 'mp3_url', 'ARTIST_ID', 'artist_id'}
 
-# get_db_session imported from models
+# Track rows are streamed into a COPY buffer and flushed with one COPY + commit per this many rows
+COPY_FLUSH_ROWS = 10_000
+COPY_COLUMNS = ('id', 'title', 'artist', 'tags', 'audio_url', 's3_key')
 
-def download_file(url, local_path, retries=3):
-    """Download a file from a URL to a local path with retries."""
-    for attempt in range(retries):
-        try:
-            with requests.get(url, stream=True, timeout=15) as r:
-                r.raise_for_status()
-                with open(local_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-            return True
-        except Exception as e:
-            logger.warning(f"Attempt {attempt + 1} failed for {url}: {e}")
-            time.sleep(2 * (attempt + 1))
-    return False
+# DB Configuration
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+def download_file(url, local_path):
+    """Download a file from a URL to a local path (retries are handled by the session adapter)."""
+    try:
+        with HTTP_SESSION.get(url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, 15)) as r:
+            r.raise_for_status()
+            with open(local_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=HTTP_CHUNK):
+                    f.write(chunk)
+        return True
+    except Exception as e:
+        logger.warning(f"Download failed for {url}: {e}")
+        return False
 
 def upload_to_s3(s3_client, local_path, s3_key):
     """Upload a file to S3."""
     try:
-        s3_client.upload_file(str(local_path), S3_BUCKET_NAME, s3_key)
+        s3_client.upload_file(str(local_path), S3_BUCKET_NAME, s3_key, Config=TRANSFER_CONFIG)
         # Using a public read assumption or presuming the bucket policy handles it.
         # If needed, we can generate a URL. For s3 compatible, usually:
         # endpoint/bucket/key
@@ -85,14 +89,161 @@ def upload_to_s3(s3_client, local_path, s3_key):
         logger.error(f"Failed to upload {s3_key}: {e}")
         return None
 
-def process_dataset(tsv_path: str, output_dir: str, limit: int = None):
+def resolve_track(row):
+    """Resolve (track_id, audio_url) from a dataset row, or ('', '') if unusable."""
+    track_id = str(row.get('TRACK_ID', row.get('track_id', row.get('id', ''))))
+
+    # URL is not in TSV, construct it from PATH if available
+    relative_path = row.get('PATH', '')
+    if not relative_path:
+         # Fallback to older columns if PATH is missing
+         relative_path = row.get('audio_url', row.get('mp3_url', ''))
+
+    if relative_path and isinstance(relative_path, str) and not relative_path.startswith('http'):
+         audio_url = f"https://cdn.freesound.org/mtg-jamendo/raw_30s/audio/{relative_path}"
+    else:
+         audio_url = relative_path
+
+    return track_id, audio_url
+
+def fetch_existing_ids(db_session, track_ids):
+    """Return the subset of track_ids already present in the DB, in one round-trip."""
+    if not db_session or not track_ids:
+        return set()
+    try:
+        result = db_session.execute(text("SELECT id FROM tracks WHERE id = ANY(:ids)"), {"ids": list(track_ids)})
+        return {r[0] for r in result}
+    except Exception as e:
+        logger.error(f"DB Check Error: {e}")
+        db_session.rollback()
+        return set()
+
+def format_copy_row(track_row):
+    """Format a track row as one line of COPY ... WITH (FORMAT text) input."""
+    values = []
+    for column in COPY_COLUMNS:
+        value = track_row.get(column)
+        if value is None:
+            values.append('\\N')
+            continue
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        values.append(
+            str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        )
+    return '\t'.join(values) + '\n'
+
+def copy_tracks(db_session, copy_buf):
+    """Bulk load a buffer of format_copy_row lines with COPY FROM STDIN on the session's connection (no commit)."""
+    copy_buf.seek(0)
+    cursor = db_session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY tracks ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT text)", copy_buf)
+    finally:
+        cursor.close()
+
+def insert_tracks(db_session, track_rows, copy_buf=None):
+    """
+    Insert a batch of track rows with a single COPY and commit.
+    copy_buf, if given, already holds format_copy_row output for track_rows.
+    """
+    if not db_session or not track_rows:
+        return
+    if copy_buf is None:
+        copy_buf = io.StringIO(''.join(format_copy_row(row) for row in track_rows))
+    try:
+        copy_tracks(db_session, copy_buf)
+        # Delivered to the vector worker on commit
+        db_session.execute(NOTIFY_NEW_TRACKS, {"count": str(len(track_rows))})
+        db_session.commit()
+        logger.info(f"{len(track_rows)} tracks saved to DB.")
+        return
+    except Exception as e:
+        # COPY is all-or-nothing, e.g. a single duplicate ID rejects the batch
+        logger.warning(f"COPY of {len(track_rows)} tracks failed, falling back to INSERT: {e}")
+        db_session.rollback()
+    try:
+        db_session.execute(pg_insert(Track).on_conflict_do_nothing(index_elements=['id']), track_rows)
+        db_session.execute(NOTIFY_NEW_TRACKS, {"count": str(len(track_rows))})
+        db_session.commit()
+        logger.info(f"{len(track_rows)} tracks saved to DB.")
+    except Exception as e:
+        logger.error(f"DB Error inserting {len(track_rows)} tracks: {e}")
+        db_session.rollback()
+
+# Per-process S3 client, created by _init_worker (boto3 clients are not fork-safe)
+_worker_s3 = None
+
+def _init_worker():
+    global _worker_s3
+    _worker_s3 = build_s3_client()
+
+def process_one(row, output_dir):
+    """
+    Download and upload a single dataset row. Runs inside a worker process.
+    Returns (processed, track_row) where track_row is the DB row to insert, if any.
+    """
+    track_id, audio_url = resolve_track(row)
+    if not track_id or not audio_url:
+        return False, None
+
+    track_row = None
+
+    filename = f"{track_id}.mp3"
+    local_file_path = Path(output_dir) / filename
+    s3_key = f"tracks/{filename}"
+    
+    logger.info(f"Processing Track {track_id}...")
+    
+    # 1. Download
+    if not local_file_path.exists():
+        success = download_file(audio_url, local_file_path)
+        if not success:
+           logger.error(f"Skipping {track_id} due to download failure.")
+           return False, None
+    
+    # 2. Upload to S3
+    if all([S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY, S3_BUCKET_NAME]):
+        final_url = upload_to_s3(_worker_s3, local_file_path, s3_key)
+        if final_url:
+            print(f"UPLOADED: {final_url}", flush=True)  # Force stdout for immediate log visibility
+            # 3. Hand the row back to the parent for a batched DB insert
+            track_row = dict(
+                id=track_id,
+                title=f"Track {track_id}", # Placeholder if title missing
+                artist=str(row.get('ARTIST_ID', row.get('artist_id', '')) or 'Unknown'),
+                tags={}, # Populate if available
+                audio_url=final_url,
+                s3_key=s3_key
+            )
+        
+        # 4. Cleanup
+        try:
+            local_file_path.unlink()
+            logger.info(f"Deleted local file {filename}")
+        except Exception as e:
+            logger.warning(f"Failed to delete {filename}: {e}")
+    else:
+         logger.warning("Skipping upload/DB (No credentials). Keeping local file.")
+
+    return True, track_row
+
+def process_dataset(tsv_path: str, output_dir: str, limit: int = None, workers: int = None):
     """
     Process the MTG-Jamendo dataset TSV.
     Expected columns: TRACK_ID, ARTIST_ID, ALBUM_ID, PATH, DURATION, TAGS
     """
     try:
         # quoting=3 is CSV.QUOTE_NONE, helps avoiding parsing errors on some tags
-        df = pd.read_csv(tsv_path, sep='\t', on_bad_lines='skip', quoting=3)
+        # Read in chunks (only the columns we use, as plain strings) to keep memory flat.
+        # Rows with several tags carry extra tab-separated TAGS fields; with usecols they are
+        # kept (a full-width read used to drop them as bad lines), so every track is ingested.
+        reader = pd.read_csv(
+            tsv_path, sep='\t', on_bad_lines='skip', quoting=3,
+            chunksize=TSV_CHUNK_ROWS,
+            usecols=lambda column: column in DATASET_COLUMNS,
+            dtype=str, na_filter=False
+        )
     except Exception as e:
         logger.error(f"Failed to read TSV: {e}")
         return
@@ -107,99 +258,68 @@ def process_dataset(tsv_path: str, output_dir: str, limit: int = None):
     except Exception as e:
         logger.error(f"Failed to initialize DB: {e}")
     
-    s3_client = get_s3_client()
+    # Check for internal railway URL if running locally
+    if DATABASE_URL and 'railway.internal' in DATABASE_URL and 'RAILWAY_ENVIRONMENT' not in os.environ:
+        logger.warning("Detected internal Railway DB URL while running locally. Connection will likely fail. Please use the TCP Proxy URL.")
+
     db_session = get_db_session()
     
     # Create bucket if it doesn't exist
     try:
-        s3_client.create_bucket(Bucket=S3_BUCKET_NAME)
+        S3_CLIENT.create_bucket(Bucket=S3_BUCKET_NAME)
     except Exception:
         pass 
 
+    workers = workers or (os.cpu_count() or 1) * 2
     processed_count = 0
+    submitted_count = 0
+    pending_rows = []
+    copy_buf = io.StringIO()
     
-    for index, row in df.iterrows():
-        if limit and processed_count >= limit:
-            break
-            
-        track_id = str(row.get('TRACK_ID', row.get('track_id', row.get('id', ''))))
-        
-        # URL is not in TSV, construct it from PATH if available
-        relative_path = row.get('PATH', '')
-        if not relative_path:
-             # Fallback to older columns if PATH is missing
-             relative_path = row.get('audio_url', row.get('mp3_url', ''))
-
-        if relative_path and isinstance(relative_path, str) and not relative_path.startswith('http'):
-             audio_url = f"https://cdn.freesound.org/mtg-jamendo/raw_30s/audio/{relative_path}"
-        else:
-             audio_url = relative_path
-        
-        if not track_id or not audio_url:
-            continue
-            
-        # Check for internal railway URL if running locally
-        if DATABASE_URL and 'railway.internal' in DATABASE_URL and 'RAILWAY_ENVIRONMENT' not in os.environ:
-            logger.warning("Detected internal Railway DB URL while running locally. Connection will likely fail. Please use the TCP Proxy URL.")
-
-        # 0. Check DB first (Optimization)
-        if db_session:
-            try:
-                existing = db_session.query(Track).filter_by(id=track_id).first()
-                if existing:
-                    logger.info(f"Track {track_id} already in DB. Skipping.")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor, \
+            tqdm(desc="Ingesting", unit="track") as progress:
+        for chunk in reader:
+            candidates = []
+            for values in chunk.itertuples(index=False, name=None):
+                row = dict(zip(chunk.columns, values))
+                track_id, audio_url = resolve_track(row)
+                if track_id and audio_url:
+                    candidates.append((track_id, row))
+
+            # 0. Check DB once per chunk for already ingested tracks instead of one query per row
+            existing = fetch_existing_ids(db_session, [track_id for track_id, _ in candidates])
+            if db_session:
+                db_session.close()  # Release the connection while workers download; reused for inserts
+            if existing:
+                logger.info(f"{len(existing)} tracks already in DB. Skipping them.")
+            rows = [row for track_id, row in candidates if track_id not in existing]
+            if limit:
+                rows = rows[:limit - submitted_count]
+            submitted_count += len(rows)
+
+            futures = [executor.submit(process_one, row, output_dir) for row in rows]
+            for future in as_completed(futures):
+                progress.update(1)
+                try:
+                    processed, track_row = future.result()
+                except Exception as e:
+                    logger.error(f"Worker failed: {e}")
                     continue
-            except Exception as e:
-                logger.error(f"DB Check Error for {track_id}: {e}")
-                # Optional: break or continue? Let's try to proceed if DB check fails, 
-                # but with rollback just in case connection is dead
-                db_session.rollback()
-
-        filename = f"{track_id}.mp3"
-        local_file_path = Path(output_dir) / filename
-        s3_key = f"tracks/{filename}"
-        
-        logger.info(f"Processing Track {track_id}...")
-        
-        # 1. Download
-        if not local_file_path.exists():
-            success = download_file(audio_url, local_file_path)
-            if not success:
-               logger.error(f"Skipping {track_id} due to download failure.")
-               continue
-        
-        # 2. Upload to S3
-        if all([S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY, S3_BUCKET_NAME]):
-            final_url = upload_to_s3(s3_client, local_file_path, s3_key)
-            if final_url:
-                print(f"UPLOADED: {final_url}", flush=True)  # Force stdout for immediate log visibility
-                # 3. Insert to DB
-                if db_session:
-                    try:
-                        new_track = Track(
-                            id=track_id,
-                            title=f"Track {track_id}", # Placeholder if title missing
-                            artist=str(row.get('artist_id', 'Unknown')),
-                            tags={}, # Populate if available
-                            audio_url=final_url
-                        )
-                        db_session.add(new_track)
-                        db_session.commit()
-                        logger.info(f"Track {track_id} metadata saved to DB.")
-                    except Exception as e:
-                        logger.error(f"DB Error for {track_id}: {e}")
-                        db_session.rollback()
-            
-            # 4. Cleanup
-            try:
-                local_file_path.unlink()
-                logger.info(f"Deleted local file {filename}")
-            except Exception as e:
-                logger.warning(f"Failed to delete {filename}: {e}")
-        else:
-             logger.warning("Skipping upload/DB (No credentials). Keeping local file.")
-
-        processed_count += 1
+                if processed:
+                    processed_count += 1
+                if track_row:
+                    pending_rows.append(track_row)
+                    copy_buf.write(format_copy_row(track_row))
+                    if len(pending_rows) >= COPY_FLUSH_ROWS:
+                        insert_tracks(db_session, pending_rows, copy_buf)
+                        pending_rows, copy_buf = [], io.StringIO()
+
+            if limit and submitted_count >= limit:
+                break
+
+    insert_tracks(db_session, pending_rows, copy_buf)
+    if db_session:
+        db_session.close()
         
     logger.info(f"Processing complete. {processed_count} tracks processed.")
 
@@ -208,6 +328,7 @@ if __name__ == "__main__":
     parser.add_argument("--tsv", required=True, help="Path to the dataset TSV file")
     parser.add_argument("--output", default="./temp_downloads", help="Directory to store downloaded files temporarily")
     parser.add_argument("--limit", type=int, help="Limit number of tracks to process")
+    parser.add_argument("--workers", type=int, help="Number of parallel worker processes (default: 2 x CPU count)")
     
     args = parser.parse_args()
     
@@ -216,4 +337,4 @@ if __name__ == "__main__":
     import sys
     sys.path.append(os.path.join(os.path.dirname(__file__), '../backend'))
     
-    process_dataset(args.tsv, args.output, args.limit)
+    process_dataset(args.tsv, args.output, args.limit, args.workers)
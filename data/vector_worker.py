@@ -1,77 +1,142 @@
-import boto3
-from botocore.config import Config
-
+import gc
+import io
 import os
+import queue
+import tempfile
 import time
 import logging
+import select
+import threading
+from logging.handlers import MemoryHandler
 import torch
-import librosa
+import torch.multiprocessing as mp
+import torchaudio
 import numpy as np
-import requests
-from pathlib import Path
-from tempfile import NamedTemporaryFile
-from transformers import ClapModel, ClapProcessor
+import soundfile as sf
+import av
+from concurrent.futures import ThreadPoolExecutor
+import transformers
+from transformers import ClapConfig, ClapFeatureExtractor, ClapModel
 from dotenv import load_dotenv
 
 import sys
 # Ensure backend import works
 sys.path.append(os.path.join(os.path.dirname(__file__), '../backend'))
 
-from models import Track, get_db_session
+from sqlalchemy import bindparam, text
+from models import Track, get_db_session, get_engine, NEW_TRACK_CHANNEL
+from clients import HTTP_CHUNK, HTTP_CONNECT_TIMEOUT, S3_BUCKET_NAME, S3_CLIENT, build_http_session
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Setup logging: records are buffered and written 64 at a time (errors immediately),
+# so the per-track lines in the hot loop don't each cost a synchronous write to the log drain
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_buffer = MemoryHandler(capacity=64, flushLevel=logging.ERROR, target=_log_stream)
+logging.basicConfig(level=logging.INFO, handlers=[_log_buffer])
 logger = logging.getLogger(__name__)
 
 load_dotenv(".env")
 
-# S3 Configuration
-S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
-S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
-S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
-S3_REGION_NAME = os.getenv("S3_REGION_NAME", "auto")
-
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-
 # Model Configuration
 MODEL_ID = "laion/clap-htsat-unfused"
 DEVICE = "cpu"
+SAMPLE_RATE = 48000
+MAX_DURATION = 30  # seconds of audio fed to the model
+# Dynamic int8 quantization of Linear layers (CPU only); set CLAP_INT8=0 to run FP32
+CLAP_INT8 = os.getenv("CLAP_INT8", "1") == "1"
+# Private cache for the quantized weights and ONNX exports (see quantized_model_path, onnx_model_paths)
+CLAP_CACHE_DIR = os.getenv("CLAP_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "ai_dj")
+# Inference backend for the audio encoder: "torch" (eager + torch.compile) or "onnx" (ONNX Runtime)
+CLAP_RUNTIME = os.getenv("CLAP_RUNTIME", "torch")
+# Optional explicit path for the FP32 export; by default a version-keyed file under CLAP_CACHE_DIR
+ONNX_MODEL_PATH = os.getenv("CLAP_ONNX_PATH")
 
-def get_s3_client():
-    return boto3.client(
-        's3',
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-        endpoint_url=S3_ENDPOINT_URL,
-        region_name=S3_REGION_NAME,
-        config=Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'path'}
-        )
+# Formats this libsndfile build can decode; anything else goes straight to PyAV
+SOUNDFILE_FORMATS = set(sf.available_formats())
+
+# Resample modules keyed on source sample rate (see get_resampler)
+_RESAMPLERS = {}
+
+# Worker processes sharing one copy of the FP32 CLAP weights (requires CLAP_INT8=0, see __main__)
+VECTOR_WORKER_PROCS = int(os.getenv("VECTOR_WORKER_PROCS", 1))
+
+# Intra-op threads for the CLAP forward pass (honour OMP_NUM_THREADS if the container sets it),
+# split across worker processes; the model runs one op at a time, so a single inter-op thread avoids oversubscription
+torch.set_num_threads(max(1, int(os.getenv("OMP_NUM_THREADS", os.cpu_count() or 1)) // VECTOR_WORKER_PROCS))
+torch.set_num_interop_threads(1)
+torch.backends.mkldnn.enabled = True
+
+# Worker queue: number of tracks claimed, downloaded and embedded per iteration (one CLAP forward)
+BATCH_SIZE = int(os.getenv("VECTOR_BATCH_SIZE", 8))
+# Run a full garbage collection after this many tracks (automatic GC is disabled in the worker loop)
+GC_INTERVAL = 100
+# Downloaded batches waiting for inference; bounds memory held by prefetched clips
+PREFETCH_BATCHES = 4
+# When idle, wait this long for a NOTIFY before polling again as a safety net
+IDLE_TIMEOUT = int(os.getenv("VECTOR_IDLE_TIMEOUT", 60))
+
+# Claims left in 'processing' longer than this (e.g. by a crashed worker) are picked up again
+CLAIM_TIMEOUT = 15 * 60
+
+# Atomically mark a batch as 'processing' and return it; SKIP LOCKED lets several
+# worker replicas claim disjoint batches concurrently without holding locks while they work
+CLAIM_BATCH_SQL = text("""
+    UPDATE tracks SET embedding_status = 'processing', embedding_claimed_at = now()
+    WHERE id IN (
+        SELECT id FROM tracks
+        WHERE embedding IS NULL
+          AND (embedding_status IS NULL
+               OR (embedding_status = 'processing'
+                   AND embedding_claimed_at < now() - make_interval(secs => :claim_timeout)))
+        ORDER BY id
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
     )
+    RETURNING id, audio_url, s3_key
+""")
+UPDATE_EMBEDDING_SQL = text(
+    "UPDATE tracks SET embedding = :embedding, embedding_status = 'done' WHERE id = :id"
+).bindparams(bindparam("embedding", type_=Track.__table__.c.embedding.type))
+# Tracks whose audio cannot be downloaded or decoded are parked instead of being reclaimed forever
+MARK_FAILED_SQL = text("UPDATE tracks SET embedding_status = 'error' WHERE id = :id")
+# Tracks that only failed in inference go back to the queue for another claim; released tracks
+# sort first (ORDER BY id), so one that keeps failing is parked after MAX_INFERENCE_ATTEMPTS
+MAX_INFERENCE_ATTEMPTS = 3
+RELEASE_CLAIM_SQL = text("""
+    UPDATE tracks SET
+        embedding_attempts = embedding_attempts + 1,
+        embedding_status = CASE WHEN embedding_attempts + 1 >= :max_attempts THEN 'error' END,
+        embedding_claimed_at = NULL
+    WHERE id = :id
+""").bindparams(max_attempts=MAX_INFERENCE_ATTEMPTS)
+
+# Only this much of each object is downloaded at first; 2 MiB covers 30 s of MP3 up to ~500 kbps
+AUDIO_PREFIX_BYTES = int(os.getenv("AUDIO_PREFIX_BYTES", 2 * 1024 * 1024))
+
+# Download threads each keep their own requests.Session (see get_http_session)
+_thread_local = threading.local()
 
-def get_presigned_url(s3_client, public_url):
-    """Generates a presigned URL from the public URL stored in DB."""
+def get_presigned_url(s3_client, public_url, s3_key=None):
+    """Generates a presigned URL from the S3 key stored in DB, falling back to parsing the public URL."""
     try:
-        # Assuming URL format: .../BUCKET_NAME/key
-        # or just extract key if we know the structure.
+        # Tracks ingested before s3_key was stored only have the full URL
         # Structure from ingest: f"{S3_ENDPOINT_URL}/{S3_BUCKET_NAME}/{s3_key}"
-        
-        if not public_url:
-            return None
-            
-        # Parse key. 
-        # Robust way: use the exact known structure or split by bucket name
-        if f"/{S3_BUCKET_NAME}/" in public_url:
-            key = public_url.split(f"/{S3_BUCKET_NAME}/")[-1]
-        else:
-            # Fallback for paths that might differ or if bucket is subdomain
-            # Ideally we stored key in DB, but we stored full URL.
-            # Let's try splitting by 'tracks/' if standard
-             if "tracks/" in public_url:
-                 key = f"tracks/{public_url.split('tracks/')[-1]}"
-             else:
-                 return public_url # Cannot parse, try raw (will likely fail 403)
+        key = s3_key
+        if not key:
+            if not public_url:
+                return None
+                
+            # Parse key. 
+            # Robust way: use the exact known structure or split by bucket name
+            if f"/{S3_BUCKET_NAME}/" in public_url:
+                key = public_url.split(f"/{S3_BUCKET_NAME}/")[-1]
+            else:
+                # Fallback for paths that might differ or if bucket is subdomain
+                # Let's try splitting by 'tracks/' if standard
+                 if "tracks/" in public_url:
+                     key = f"tracks/{public_url.split('tracks/')[-1]}"
+                 else:
+                     return public_url # Cannot parse, try raw (will likely fail 403)
 
         url = s3_client.generate_presigned_url(
             'get_object',
@@ -83,121 +148,609 @@ def get_presigned_url(s3_client, public_url):
         logger.error(f"Presigning failed: {e}")
         return public_url
 
+def quantized_model_path():
+    """State dict cache path, keyed on the model and library versions so an upgrade never loads a stale file."""
+    name = f"{MODEL_ID.replace('/', '--')}-int8-torch{torch.__version__}-transformers{transformers.__version__}.pt"
+    return os.path.join(CLAP_CACHE_DIR, name)
+
+def quantize_model(model):
+    """Dynamic int8 quantization of the model's Linear layers."""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_quantized_model():
+    """Loads CLAP with int8 dynamically quantized Linear layers, cached on disk after the first run."""
+    # oneDNN int8 kernels use VNNI where the CPU has it; weights are packed for the active engine
+    if "onednn" in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = "onednn"
+
+    cache_path = quantized_model_path()
+    if os.path.exists(cache_path):
+        try:
+            # Tensors only (no pickled code), loaded into a freshly quantized skeleton built from the config
+            model = quantize_model(ClapModel(ClapConfig.from_pretrained(MODEL_ID)))
+            model.load_state_dict(torch.load(cache_path, weights_only=True))
+            return model
+        except Exception as e:
+            logger.warning(f"Could not load cached quantized model, re-quantizing: {e}")
+
+    model = quantize_model(ClapModel.from_pretrained(MODEL_ID))
+    try:
+        os.makedirs(CLAP_CACHE_DIR, mode=0o700, exist_ok=True)
+        torch.save(model.state_dict(), cache_path)
+    except Exception as e:
+        logger.warning(f"Could not cache quantized model at {cache_path}: {e}")
+    return model
+
+class LogMelFrontend:
+    """
+    Batched torch replacement for ClapFeatureExtractor (the rand_trunc / repeatpad path of the unfused checkpoint).
+    The Hann window and mel filter bank are built once here instead of on every processor call,
+    and a whole batch is transformed with a single STFT into a waveform buffer reused across batches.
+    """
+
+    def __init__(self, feature_extractor):
+        if feature_extractor.truncation != "rand_trunc" or feature_extractor.padding != "repeatpad":
+            raise ValueError(
+                f"LogMelFrontend only implements rand_trunc / repeatpad, not "
+                f"{feature_extractor.truncation} / {feature_extractor.padding}"
+            )
+        self.n_fft = feature_extractor.fft_window_size
+        self.hop_length = feature_extractor.hop_length
+        # Every clip is cropped / repeat-padded to this many samples (10 s at 48kHz)
+        self.max_samples = feature_extractor.nb_max_samples
+        self.window = torch.hann_window(self.n_fft)
+        # (n_freq, n_mels) -> (n_mels, n_freq), same slaney filters the extractor applies
+        self.mel_filters = torch.from_numpy(feature_extractor.mel_filters_slaney.T).float()
+        # (rows, max_samples) float32, grown to the largest batch seen; only used from the inference thread
+        self.wav_buffer = np.empty((0, self.max_samples), dtype=np.float32)
+
+    def fit_length(self, wav, out):
+        """Randomly crops longer clips and repeat-pads shorter ones into out (max_samples), like the HF extractor."""
+        if len(wav) >= self.max_samples:
+            offset = np.random.randint(0, len(wav) - self.max_samples + 1)
+            out[:] = wav[offset:offset + self.max_samples]
+            return
+        n_repeat = self.max_samples // len(wav)
+        out[:n_repeat * len(wav)].reshape(n_repeat, len(wav))[:] = wav
+        out[n_repeat * len(wav):] = 0.0
+
+    def __call__(self, audio_arrays):
+        """Returns input_features of shape (batch, 1, frames, n_mels) for get_audio_features."""
+        if len(self.wav_buffer) < len(audio_arrays):
+            self.wav_buffer = np.empty((len(audio_arrays), self.max_samples), dtype=np.float32)
+        wavs = self.wav_buffer[:len(audio_arrays)]
+        for wav, out in zip(audio_arrays, wavs):
+            self.fit_length(wav, out)
+        stft = torch.stft(torch.from_numpy(wavs), self.n_fft, hop_length=self.hop_length, window=self.window,
+                          center=True, pad_mode="reflect", return_complex=True)
+        mel = torch.matmul(self.mel_filters, stft.abs().pow_(2))
+        log_mel = mel.clamp_(min=1e-10).log10_().mul_(10.0)
+        return log_mel.transpose(1, 2).unsqueeze(1)
+
+class ClapAudioEncoder(torch.nn.Module):
+    """
+    Audio tower + projection of a ClapModel, i.e. get_audio_features as a plain tensor -> tensor forward.
+    Leaves the text tower behind and is what gets compiled or exported to ONNX.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.audio_model = model.audio_model
+        self.audio_projection = model.audio_projection
+
+    def forward(self, input_features):
+        audio_outputs = self.audio_model(input_features=input_features)
+        return self.audio_projection(audio_outputs.pooler_output)
+
+class OnnxAudioEncoder:
+    """ONNX Runtime session over an exported ClapAudioEncoder, with the same call signature."""
+
+    def __init__(self, path):
+        import onnxruntime as ort
+
+        self.path = path
+        sess_options = ort.SessionOptions()
+        # Fuses LayerNorm / GELU / attention and folds constants
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = torch.get_num_threads()
+        sess_options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, sess_options=sess_options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_features):
+        outputs = self.session.run(None, {"input_features": input_features.numpy()})[0]
+        return torch.from_numpy(outputs)
+
+    # Sessions cannot be pickled; spawned workers reopen the exported model instead
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+def onnx_model_paths():
+    """(FP32, int8) export paths, keyed on the model and library versions like quantized_model_path."""
+    fp32_path = ONNX_MODEL_PATH
+    if not fp32_path:
+        import onnxruntime
+        name = (f"{MODEL_ID.replace('/', '--')}-audio-torch{torch.__version__}"
+                f"-transformers{transformers.__version__}-ort{onnxruntime.__version__}.onnx")
+        fp32_path = os.path.join(CLAP_CACHE_DIR, name)
+    return fp32_path, os.path.splitext(fp32_path)[0] + "-int8.onnx"
+
+def write_atomically(path, write):
+    """Calls write(tmp_path) and renames the result to path, so a crash never leaves a half-written file there."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".onnx.tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def export_onnx_model(frontend):
+    """Exports the FP32 audio encoder to ONNX (int8-quantized if CLAP_INT8), cached on disk after the first run."""
+    fp32_path, int8_path = onnx_model_paths()
+    onnx_path = int8_path if CLAP_INT8 else fp32_path
+    if os.path.exists(onnx_path):
+        return onnx_path
+
+    if not os.path.exists(fp32_path):
+        encoder = ClapAudioEncoder(ClapModel.from_pretrained(MODEL_ID)).eval()
+        example_features = frontend([np.zeros(frontend.max_samples, dtype=np.float32)])
+        write_atomically(fp32_path, lambda tmp_path: torch.onnx.export(
+            encoder, (example_features,), tmp_path,
+            input_names=["input_features"], output_names=["audio_embeds"],
+            dynamic_axes={"input_features": {0: "batch"}, "audio_embeds": {0: "batch"}},
+            opset_version=17,
+            # TorchScript exporter: only needs onnx (the dynamo default since torch 2.9 also needs onnxscript)
+            dynamo=False
+        ))
+
+    if CLAP_INT8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        write_atomically(int8_path, lambda tmp_path: quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8))
+    return onnx_path
+
+def load_onnx_encoder(frontend):
+    """Opens the cached ONNX export, re-exporting once if the cached file cannot be loaded."""
+    try:
+        return OnnxAudioEncoder(export_onnx_model(frontend))
+    except Exception as e:
+        # e.g. a file truncated by a crash during an older, non-atomic export
+        logger.warning(f"Could not load cached ONNX model, re-exporting: {e}")
+    for path in onnx_model_paths():
+        if os.path.exists(path):
+            os.remove(path)
+    return OnnxAudioEncoder(export_onnx_model(frontend))
+
 def load_model():
-    # ... (existing load_model code)
-    logger.info(f"Loading CLAP model: {MODEL_ID} on {DEVICE}...")
+    """Returns (encoder, frontend); encoder maps log-mel input_features to unnormalized audio embeddings."""
+    logger.info(f"Loading CLAP model: {MODEL_ID} on {DEVICE} ({CLAP_RUNTIME})...")
     try:
-        model = ClapModel.from_pretrained(MODEL_ID).to(DEVICE)
-        processor = ClapProcessor.from_pretrained(MODEL_ID)
+        frontend = LogMelFrontend(ClapFeatureExtractor.from_pretrained(MODEL_ID))
+        if CLAP_RUNTIME == "onnx":
+            encoder = load_onnx_encoder(frontend)
+        else:
+            # Dynamic quantization only has CPU kernels
+            if DEVICE == "cpu" and CLAP_INT8:
+                model = load_quantized_model()
+            else:
+                model = ClapModel.from_pretrained(MODEL_ID).to(DEVICE)
+            encoder = ClapAudioEncoder(model).eval()
         logger.info("Model loaded successfully.")
-        return model, processor
+        return encoder, frontend
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
         sys.exit(1)
 
-def download_audio(url):
-    """Downloads audio to a temporary file and returns path."""
+def get_http_session():
+    """Returns this thread's requests.Session, so keep-alive connections are reused across downloads."""
+    http_session = getattr(_thread_local, "http_session", None)
+    if http_session is None:
+        http_session = _thread_local.http_session = build_http_session()
+    return http_session
+
+def download_audio(url, max_bytes=None):
+    """
+    Downloads audio into memory, optionally only the first max_bytes (HTTP Range).
+    Returns (BytesIO, truncated), where truncated means the object is larger than what was fetched,
+    or (None, False) on failure.
+    """
+    headers = {"Range": f"bytes=0-{max_bytes - 1}"} if max_bytes else None
     try:
-        # ... (existing download_audio code)
-        response = requests.get(url, stream=True, timeout=10)
-        response.raise_for_status()
-        suffix = ".mp3" # Force mp3 since we know it is, or derive from headers
-        with NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-            for chunk in response.iter_content(chunk_size=8192):
-                tmp_file.write(chunk)
-            return tmp_file.name
+        with get_http_session().get(url, headers=headers, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, 10)) as response:
+            response.raise_for_status()
+            audio = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=HTTP_CHUNK):
+                audio.write(chunk)
+            audio.seek(0)
+            # Partial content: "Content-Range: bytes 0-1048575/5242880"
+            total_size = response.headers.get("Content-Range", "").rpartition("/")[2]
+            # An unknown total ("bytes 0-1048575/*") may be larger than the prefix
+            truncated = response.status_code == 206 and (
+                not total_size.isdigit() or int(total_size) > audio.getbuffer().nbytes
+            )
+            return audio, truncated
     except Exception as e:
         logger.error(f"Download failed for {url}: {e}")
+        return None, False
+
+def get_resampler(sample_rate):
+    """Returns a cached Resample module to 48kHz, so the FIR kernel is built once per source rate."""
+    resampler = _RESAMPLERS.get(sample_rate)
+    if resampler is None:
+        resampler = _RESAMPLERS[sample_rate] = torchaudio.transforms.Resample(
+            sample_rate, SAMPLE_RATE,
+            resampling_method="sinc_interp_kaiser",
+            lowpass_filter_width=16
+        )
+    return resampler
+
+def decode_with_av(audio):
+    """Decodes the first MAX_DURATION seconds with PyAV (FFmpeg) for formats libsndfile cannot read."""
+    audio.seek(0)
+    chunks, n_samples = [], 0
+    with av.open(audio) as container:
+        stream = container.streams.audio[0]
+        sample_rate = stream.rate
+        max_samples = MAX_DURATION * sample_rate
+        to_mono = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+        for frame in container.decode(stream):
+            for mono_frame in to_mono.resample(frame):
+                chunk = mono_frame.to_ndarray().reshape(-1)
+                chunks.append(chunk)
+                n_samples += len(chunk)
+            if n_samples >= max_samples:
+                break
+    if not chunks:
+        raise ValueError("no audio frames decoded")
+    return np.concatenate(chunks)[:max_samples], sample_rate
+
+def sniff_format(audio):
+    """Returns the libsndfile format name for an in-memory clip from its magic bytes, or None if unknown."""
+    header = audio.getbuffer()[:12].tobytes()
+    if header.startswith(b"ID3") or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE6 == 0xE2):
+        # ID3 tag or a bare MPEG layer III frame sync
+        audio_format = "MP3"
+    else:
+        audio_format = {b"RIFF": "WAV", b"OggS": "OGG", b"fLaC": "FLAC"}.get(header[:4])
+    # Older libsndfile builds have no MP3 support
+    return audio_format if audio_format in SOUNDFILE_FORMATS else None
+
+def decode_audio(audio):
+    """Decodes the first MAX_DURATION seconds of an in-memory clip to mono float32 at its source rate."""
+    # libsndfile detects the container itself (it rejects a format hint for reads); sniffing only
+    # spares unknown formats a failed libsndfile probe before PyAV
+    if sniff_format(audio) is None:
+        return decode_with_av(audio)
+    try:
+        with sf.SoundFile(audio) as audio_file:
+            sample_rate = audio_file.samplerate
+            wav = audio_file.read(frames=MAX_DURATION * sample_rate, dtype="float32", always_2d=True)
+        return wav.mean(axis=1), sample_rate
+    except RuntimeError:
+        # Mislabelled or unusual files (e.g. an Ogg stream with an unsupported codec)
+        return decode_with_av(audio)
+
+def fetch_audio(url):
+    """
+    Downloads and decodes a clip to mono float32 at its source rate; runs on the download threads.
+    Only the first AUDIO_PREFIX_BYTES are requested, and the whole file is fetched only if that
+    prefix of a larger file does not decode to MAX_DURATION seconds.
+    Returns (wav, sample_rate), or None if the clip could not be downloaded or decoded.
+    """
+    audio, truncated = download_audio(url, AUDIO_PREFIX_BYTES)
+    if audio is None:
+        return None
+    try:
+        wav, sample_rate = decode_audio(audio)
+        if not truncated or len(wav) >= MAX_DURATION * sample_rate:
+            return wav, sample_rate
+    except Exception as e:
+        if not truncated:
+            logger.error(f"Decoding failed for {url}: {e}")
+            return None
+        # The prefix may end mid-header or mid-frame; retry with the whole file
+
+    audio, _ = download_audio(url)
+    if audio is None:
+        return None
+    try:
+        return decode_audio(audio)
+    except Exception as e:
+        logger.error(f"Decoding failed for {url}: {e}")
         return None
 
-def generate_embedding(model, processor, audio_path):
-    """Generates audio embedding using CLAP."""
+def load_audio(wav, sample_rate):
+    """Resamples a decoded clip to 48kHz for CLAP."""
+    # e.g. a zero-frame WAV decodes cleanly, but cannot be repeat-padded by the frontend
+    if len(wav) == 0:
+        raise ValueError("clip has no audio samples")
+    # CLAP expects 48kHz usually (check config, but 48k is standard for CLAP)
+    wav = torch.from_numpy(wav).unsqueeze(0)
+    if sample_rate != SAMPLE_RATE:
+        wav = get_resampler(sample_rate)(wav)
+    return wav[0].numpy()
+
+def prepare_audio(clip):
+    """Resamples a decoded (wav, sample_rate) clip for CLAP, or returns None if it is missing or unusable."""
+    if clip is None:
+        return None
     try:
-        # Load and resample audio
-        # CLAP expects 48kHz usually (check config, but 48k is standard for CLAP)
-        audio_array, sample_rate = librosa.load(audio_path, sr=48000)
-        
-        # Limit duration to 30s
-        max_duration = 30
-        if len(audio_array) > max_duration * sample_rate:
-            audio_array = audio_array[:max_duration * sample_rate]
-
-        # Process inputs
-        inputs = processor(audios=audio_array, sampling_rate=48000, return_tensors="pt", padding=True)
-        inputs = {k: v.to(DEVICE) for k, v in inputs.items()}
-
-        with torch.no_grad():
-            outputs = model.get_audio_features(**inputs)
-        
-        # Retrieve embedding
-        embedding = outputs[0].cpu().numpy().tolist()
-        return embedding
+        return load_audio(*clip)
     except Exception as e:
-        logger.error(f"Inference failed for {audio_path}: {e}")
+        logger.error(f"Resampling failed: {e}")
         return None
 
-def process_queue():
-    model, processor = load_model()
-    session = get_db_session()
-    s3_client = get_s3_client()
-    
-    if not session:
+def generate_embeddings(encoder, frontend, audio_arrays):
+    """
+    Generates CLAP audio embeddings for a batch of 48kHz clips in a single forward pass.
+    Returns a float16 ndarray with one row per clip; raises if inference fails.
+    """
+    n_clips = len(audio_arrays)
+    if isinstance(encoder, torch.nn.Module) and n_clips < BATCH_SIZE:
+        # Repeat the last clip up to BATCH_SIZE, so short claims, failed clips and one-at-a-time
+        # retries reuse the warmed-up compiled graph instead of recompiling for a new batch size
+        audio_arrays = list(audio_arrays) + [audio_arrays[-1]] * (BATCH_SIZE - n_clips)
+
+    with torch.inference_mode():
+        # Fixed-length log-mel input and (for torch) a fixed batch size, so the compiled graph
+        # always sees the same shape. Every clip fills the whole window (cropped or repeat-padded),
+        # so there is no zero padding between clips to bucket or mask away.
+        input_features = frontend(audio_arrays).to(DEVICE)
+        outputs = encoder(input_features)[:n_clips]
+    # Store unit vectors so cosine queries need no server-side normalization
+    outputs = torch.nn.functional.normalize(outputs, dim=-1)
+    # The column is halfvec, so hand over FP16 values; one contiguous array for the whole batch
+    return np.ascontiguousarray(outputs.to(torch.float16).cpu().numpy())
+
+def embed_batch(encoder, frontend, audio_arrays):
+    """
+    Returns embeddings aligned with audio_arrays (row views into the batch array); None marks clips
+    whose inference failed. The ONNX encoder retries each clip on its own so one bad clip does not
+    sink the rest; the torch encoder pads every call to BATCH_SIZE, so a retry would only rerun the
+    failed shape n times and the whole batch is released instead.
+    """
+    try:
+        return list(generate_embeddings(encoder, frontend, audio_arrays))
+    except Exception as e:
+        if isinstance(encoder, torch.nn.Module):
+            logger.error(f"Inference failed for batch: {e}")
+            return [None] * len(audio_arrays)
+        logger.error(f"Inference failed for batch, retrying clips one at a time: {e}")
+
+    embeddings = []
+    for audio in audio_arrays:
+        try:
+            embeddings.append(generate_embeddings(encoder, frontend, [audio])[0])
+        except Exception as e:
+            logger.error(f"Inference failed for clip: {e}")
+            embeddings.append(None)
+    return embeddings
+
+def execute_in_transaction(statement, params):
+    """Runs one statement (or executemany) in its own short transaction; commits on exit, rolls back on error."""
+    with get_db_session() as session, session.begin():
+        session.execute(statement, params)
+
+def write_results(updates, failed, released):
+    """
+    Writes a batch's outcome in one transaction and returns the vectorized track ids.
+    If that fails (e.g. the database rejects one embedding), each track is written in its own
+    transaction and any track whose write still fails is parked as 'error', so no track is left
+    in 'processing' to be reclaimed and fail the same way forever.
+    """
+    writes = [(UPDATE_EMBEDDING_SQL, update) for update in updates]
+    writes += [(MARK_FAILED_SQL, {"id": track_id}) for track_id in failed]
+    writes += [(RELEASE_CLAIM_SQL, {"id": track_id}) for track_id in released]
+    try:
+        # One short transaction per batch; one executemany per statement, sent as a single
+        # execute_batch round trip (see get_engine)
+        with get_db_session() as session, session.begin():
+            if updates:
+                session.execute(UPDATE_EMBEDDING_SQL, updates)
+            if failed:
+                session.execute(MARK_FAILED_SQL, [{"id": track_id} for track_id in failed])
+            if released:
+                session.execute(RELEASE_CLAIM_SQL, [{"id": track_id} for track_id in released])
+        return [update["id"] for update in updates]
+    except Exception as e:
+        logger.error(f"DB Update failed for batch, writing tracks one at a time: {e}")
+
+    vectorized = []
+    for statement, params in writes:
+        try:
+            execute_in_transaction(statement, params)
+            if statement is UPDATE_EMBEDDING_SQL:
+                vectorized.append(params["id"])
+            continue
+        except Exception as e:
+            logger.error(f"DB Update failed for {params['id']}: {e}")
+        if statement is not MARK_FAILED_SQL:
+            try:
+                execute_in_transaction(MARK_FAILED_SQL, {"id": params["id"]})
+            except Exception as e:
+                logger.error(f"Could not park {params['id']}: {e}")
+    return vectorized
+
+def open_listen_connection():
+    """Opens a dedicated autocommit connection that LISTENs for new-track notifications."""
+    try:
+        conn = get_engine().raw_connection()
+        conn.detach()  # Held for the worker's lifetime, so keep it out of the pool
+        dbapi_conn = conn.dbapi_connection
+        dbapi_conn.autocommit = True
+        with dbapi_conn.cursor() as cur:
+            cur.execute(f"LISTEN {NEW_TRACK_CHANNEL}")
+        return dbapi_conn
+    except Exception as e:
+        logger.warning(f"Could not LISTEN for new tracks, falling back to polling: {e}")
+        return None
+
+def wait_for_tracks(listen_conn, timeout):
+    """
+    Blocks until the ingester NOTIFYs new tracks or timeout expires.
+    Returns the connection to keep listening on, or None if it failed and must be reopened.
+    """
+    # Nothing else will fill the log buffer while idle
+    _log_buffer.flush()
+    if listen_conn is None:
+        time.sleep(timeout)
+        return None
+    try:
+        if select.select([listen_conn], [], [], timeout)[0]:
+            listen_conn.poll()
+            # Several ingest batches may have committed while we were waiting
+            new_tracks = sum(int(n.payload) for n in listen_conn.notifies if n.payload.isdigit())
+            listen_conn.notifies.clear()
+            logger.info(f"Notified of {new_tracks} new tracks.")
+        return listen_conn
+    except Exception as e:
+        logger.warning(f"LISTEN connection failed: {e}")
+        try:
+            listen_conn.close()
+        except Exception:
+            pass
+        time.sleep(timeout)
+        return None
+
+def prefetch_batches(batches):
+    """
+    Background loop: claims batches, downloads and decodes them and queues (batch, clips) for inference,
+    so the next batch downloads while the current one runs through CLAP.
+    """
+    # Downloads are I/O-bound, so a thread per track in the batch keeps the link busy
+    download_pool = ThreadPoolExecutor(max_workers=BATCH_SIZE)
+    # LISTEN from the start so tracks committed while a batch is processing still wake us
+    listen_conn = open_listen_connection()
+
+    while True:
+        try:
+            # Claim a batch in its own short transaction, so no row locks (or pooled
+            # connection) are held while we download or wait
+            with get_db_session() as session, session.begin():
+                batch = session.execute(
+                    CLAIM_BATCH_SQL, {"batch_size": BATCH_SIZE, "claim_timeout": CLAIM_TIMEOUT}
+                ).fetchall()
+
+            if not batch:
+                logger.info(f"No pending tracks found. Waiting up to {IDLE_TIMEOUT}s for new tracks...")
+                if listen_conn is None:
+                    listen_conn = open_listen_connection()
+                listen_conn = wait_for_tracks(listen_conn, IDLE_TIMEOUT)
+                continue
+                
+            logger.info(f"Downloading {len(batch)} tracks: {[track.id for track in batch]}")
+            
+            # Presign the whole batch up front, then download and decode concurrently
+            download_urls = [get_presigned_url(S3_CLIENT, track.audio_url, track.s3_key) for track in batch]
+            clips = list(download_pool.map(fetch_audio, download_urls))
+
+            # Blocks while inference is PREFETCH_BATCHES behind
+            batches.put((batch, clips))
+
+        except Exception as e:
+            logger.error(f"Unexpected error in prefetch loop: {e}")
+            time.sleep(5)
+
+def compile_encoder(encoder):
+    """Compiles a torch encoder in this process; compiled modules cannot be sent to spawned workers."""
+    if not isinstance(encoder, torch.nn.Module):
+        return encoder  # ONNX Runtime already optimized the graph
+    # Fall back to eager execution for any graph torch.compile cannot handle
+    torch._dynamo.config.suppress_errors = True
+    return torch.compile(encoder, mode="reduce-overhead")
+
+def warm_up(encoder, frontend):
+    """Runs one full batch of silence through the pipeline, so the torch encoder compiles its only batch shape up front."""
+    start = time.time()
+    silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+    generate_embeddings(encoder, frontend, [silence] * BATCH_SIZE)
+    logger.info(f"Warm-up forward pass took {time.time() - start:.1f}s.")
+
+def process_queue(encoder, frontend):
+    encoder = compile_encoder(encoder)
+    warm_up(encoder, frontend)
+    # The model's objects live for the whole run: keep them out of GC scans, and collect
+    # on our own schedule instead of whenever per-batch allocations cross the threshold
+    gc.freeze()
+    gc.disable()
+    tracks_since_gc = 0
+    if get_engine() is None:
         logger.error("Could not connect to database.")
         sys.exit(1)
 
+    batches = queue.Queue(maxsize=PREFETCH_BATCHES)
+    threading.Thread(target=prefetch_batches, args=(batches,), name="prefetch", daemon=True).start()
+
     logger.info("Starting Vector Worker Loop...")
     
     while True:
+        batch, clips = batches.get()
         try:
-            track = session.query(Track).filter(Track.embedding == None).first()
-            
-            if not track:
-                logger.info("No pending tracks found. Sleeping 10s...")
-                time.sleep(10)
-                session.expire_all()
-                continue
-                
-            logger.info(f"Processing Track {track.id}...")
-            
-            # Generate Presigned URL
-            download_url = get_presigned_url(s3_client, track.audio_url)
-            
-            # Download
-            temp_path = download_audio(download_url)
-            if not temp_path:
-                logger.warning(f"Could not download audio for {track.id}.")
-                time.sleep(5) 
-                continue
+            logger.info(f"Processing {len(batch)} tracks: {[track.id for track in batch]}")
 
-            # ... (Rest of processing)
-            # Embedding
-            embedding = generate_embedding(model, processor, temp_path)
-            
-            # Cleanup temp file
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except:
-                pass
-
-            if embedding:
-                track.embedding = embedding
-                try:
-                    session.commit()
-                    print(f"VECTORIZED: Track {track.id}", flush=True) 
-                except Exception as e:
-                    logger.error(f"DB Update failed: {e}")
-                    session.rollback()
-            else:
-                 logger.warning(f"Embedding generation returned None for {track.id}")
+            updates, failed, released = [], [], []
+            audio_arrays = [prepare_audio(clip) for clip in clips]
+            usable = []
+            for track, audio in zip(batch, audio_arrays):
+                if audio is None:
+                    logger.warning(f"Could not download or decode audio for {track.id}.")
+                    failed.append(track.id)
+                else:
+                    usable.append((track, audio))
 
-            # yield execution slightly
-            # time.sleep(0.1)
+            if usable:
+                # Embeddings, one forward pass for the whole batch
+                embeddings = embed_batch(encoder, frontend, [audio for _, audio in usable])
+                for (track, _), embedding in zip(usable, embeddings):
+                    if embedding is None:
+                        logger.warning(f"Inference failed for {track.id}, releasing it for retry.")
+                        released.append(track.id)
+                    elif not np.isfinite(embedding).all():
+                        # e.g. NaN / Inf samples in a float WAV or FLAC; pgvector rejects the vector
+                        logger.warning(f"Non-finite embedding for {track.id}.")
+                        failed.append(track.id)
+                    else:
+                        updates.append({"id": track.id, "embedding": embedding})
+
+            for track_id in write_results(updates, failed, released):
+                logger.info("VECTORIZED: Track %s", track_id)
 
         except Exception as e:
             logger.error(f"Unexpected error in worker loop: {e}")
-            session.rollback()
             time.sleep(5)
 
+        tracks_since_gc += len(batch)
+        if tracks_since_gc >= GC_INTERVAL:
+            gc.collect()
+            tracks_since_gc = 0
+
+def worker_loop(rank, encoder, frontend):
+    """mp.spawn entry point; each worker process claims its own batches with SKIP LOCKED."""
+    logger.info(f"Vector worker process {rank} started with {torch.get_num_threads()} threads.")
+    process_queue(encoder, frontend)
+
 if __name__ == "__main__":
-    process_queue()
+    if VECTOR_WORKER_PROCS > 1 and CLAP_RUNTIME == "torch" and CLAP_INT8:
+        # Packed int8 Linear weights (most of the model) cannot live in shared memory, so every
+        # worker would get its own copy, defeating the point of sharing one loaded model
+        logger.error("VECTOR_WORKER_PROCS > 1 shares FP32 weights only; set CLAP_INT8=0 (or run a single process).")
+        sys.exit(1)
+    if VECTOR_WORKER_PROCS > 1 and CLAP_RUNTIME == "onnx":
+        logger.warning("ONNX Runtime sessions are not shared: each worker process loads its own copy of the model.")
+
+    encoder, frontend = load_model()
+    if VECTOR_WORKER_PROCS > 1:
+        if isinstance(encoder, torch.nn.Module):
+            # Workers receive shared-memory handles instead of pickled copies of the weights
+            for param in encoder.parameters():
+                param.share_memory_()
+            for buffer in encoder.buffers():
+                buffer.share_memory_()
+        mp.spawn(worker_loop, args=(encoder, frontend), nprocs=VECTOR_WORKER_PROCS)
+    else:
+        process_queue(encoder, frontend)
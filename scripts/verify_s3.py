@@ -1,32 +1,31 @@
-import boto3
 import os
-from dotenv import load_dotenv
+import sys
 
-load_dotenv(".env")
+# Add backend to path to import the shared clients
+sys.path.append(os.path.join(os.path.dirname(__file__), '../backend'))
 
-S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
-S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
-S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+from clients import S3_BUCKET_NAME, S3_ENDPOINT_URL, build_s3_client
 
 def list_bucket_contents():
     print(f"Connecting to {S3_ENDPOINT_URL} bucket {S3_BUCKET_NAME}...")
     try:
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=S3_ACCESS_KEY_ID,
-            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-            endpoint_url=S3_ENDPOINT_URL,
-        )
-        
-        response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME)
-        
-        if 'Contents' in response:
-            print(f"Found {len(response['Contents'])} objects:")
-            total_size = 0
-            for obj in response['Contents']:
+        # A couple of attempts, not the data scripts' ten: a bad endpoint should fail quickly here
+        s3 = build_s3_client(max_attempts=2)
+
+        # list_objects_v2 returns at most 1000 keys per call; walk every page
+        paginator = s3.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=S3_BUCKET_NAME, PaginationConfig={'PageSize': 1000})
+
+        object_count = 0
+        total_size = 0
+        for page in pages:
+            for obj in page.get('Contents', []):
                 print(f"- {obj['Key']} ({obj['Size']} bytes)")
+                object_count += 1
                 total_size += obj['Size']
+
+        if object_count:
+            print(f"Found {object_count} objects.")
             print(f"Total size visible via API: {total_size / 1024 / 1024:.2f} MB")
         else:
             print("Bucket is empty (or no objects returned).")
@@ -1,3 +1,4 @@
+import hashlib
 import pytest
 import sys
 import os
@@ -9,28 +10,49 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../data'))
 
 # Mock models first
 sys.modules['models'] = MagicMock()
-from ingest_mtg import download_file, upload_to_s3
+from ingest_mtg import download_file, upload_to_s3, format_copy_row, HTTP_CHUNK, TRANSFER_CONFIG
+
+def file_digest(path):
+    # Hash the file in chunks rather than reading it into memory
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def test_download_file(tmp_path):
-    # Mock requests.get
-    with patch('requests.get') as mock_get:
-        mock_get.return_value.__enter__.return_value.iter_content.return_value = [b'data']
-        mock_get.return_value.__enter__.return_value.raise_for_status = MagicMock()
+    chunks = [b'data'] * 1024
+    # Mock the pooled session's get; the body is streamed like the real iter_content
+    with patch('ingest_mtg.HTTP_SESSION.get') as mock_get:
+        response = mock_get.return_value.__enter__.return_value
+        response.iter_content.side_effect = lambda chunk_size: iter(chunks)
+        response.raise_for_status = MagicMock()
         
         dest = tmp_path / "test.mp3"
         assert download_file("http://example.com/test.mp3", dest) == True
         assert dest.exists()
-        assert dest.read_bytes() == b'data'
+        response.iter_content.assert_called_once_with(chunk_size=HTTP_CHUNK)
+        assert file_digest(dest) == hashlib.sha256(b''.join(chunks)).hexdigest()
 
 def test_upload_to_s3():
     mock_s3 = MagicMock()
-    # Mock environment variables for valid creds
-    with patch.dict(os.environ, {
-        "AWS_ACCESS_KEY_ID": "test",
-        "AWS_SECRET_ACCESS_KEY": "test", 
-        "AWS_ENDPOINT_URL": "http://s3.local",
-        "AWS_BUCKET_NAME": "test-bucket"
-    }):
+    # Patch the module-level S3 settings (read from the environment at import time)
+    with patch.multiple(
+        'ingest_mtg',
+        S3_ENDPOINT_URL="http://s3.local",
+        S3_BUCKET_NAME="test-bucket"
+    ):
         url = upload_to_s3(mock_s3, "local.mp3", "remote.mp3")
         assert url == "http://s3.local/test-bucket/remote.mp3"
-        mock_s3.upload_file.assert_called_with("local.mp3", "test-bucket", "remote.mp3")
+        mock_s3.upload_file.assert_called_with("local.mp3", "test-bucket", "remote.mp3", Config=TRANSFER_CONFIG)
+
+def test_format_copy_row():
+    line = format_copy_row({
+        "id": "track_1",
+        "title": "Tab\there",
+        "artist": "Back\\slash",
+        "tags": {},
+        "audio_url": "http://s3.local/test-bucket/tracks/track_1.mp3",
+        "s3_key": None
+    })
+    assert line == "track_1\tTab\\there\tBack\\\\slash\t{}\thttp://s3.local/test-bucket/tracks/track_1.mp3\t\\N\n"
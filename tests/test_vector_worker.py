@@ -0,0 +1,158 @@
+import pytest
+import sys
+import os
+import io
+import numpy as np
+import soundfile as sf
+from unittest.mock import MagicMock, patch
+
+# Add backend and data to path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../backend'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../data'))
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchaudio")
+transformers = pytest.importorskip("transformers")
+
+# test_ingestion swaps in a MagicMock for models; the worker needs the real column types
+if not hasattr(sys.modules.get('models'), '__file__'):
+    sys.modules.pop('models', None)
+import vector_worker
+from vector_worker import LogMelFrontend, SAMPLE_RATE, MAX_DURATION, decode_audio, fetch_audio, sniff_format
+
+def make_feature_extractor():
+    # Settings of the laion/clap-htsat-unfused preprocessor config, built locally (no hub download)
+    return transformers.ClapFeatureExtractor(
+        feature_size=64,
+        sampling_rate=SAMPLE_RATE,
+        hop_length=480,
+        max_length_s=10,
+        fft_window_size=1024,
+        frequency_min=50,
+        frequency_max=14000,
+        truncation="rand_trunc",
+        padding="repeatpad"
+    )
+
+def reference_features(feature_extractor, wav, seed):
+    np.random.seed(seed)
+    return feature_extractor(wav, sampling_rate=SAMPLE_RATE, return_tensors="np")["input_features"]
+
+def frontend_features(frontend, wav, seed):
+    np.random.seed(seed)
+    return frontend([wav]).numpy()
+
+@pytest.mark.parametrize("duration", [3.3, 25.0])
+def test_log_mel_frontend_matches_feature_extractor(duration):
+    # 3.3 s takes the repeatpad path, 25 s the (seeded) random crop
+    wav = np.random.default_rng(0).uniform(-0.5, 0.5, int(duration * SAMPLE_RATE)).astype(np.float32)
+    feature_extractor = make_feature_extractor()
+    frontend = LogMelFrontend(feature_extractor)
+
+    expected = reference_features(feature_extractor, wav, seed=1234)
+    actual = frontend_features(frontend, wav, seed=1234)
+
+    assert actual.shape == expected.shape
+    # float32 vs the extractor's float64; the zero-padded tail sits near the 1e-10 floor
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=5e-3)
+
+@pytest.mark.parametrize("settings", [{"truncation": "fusion"}, {"padding": "repeat"}])
+def test_log_mel_frontend_rejects_other_modes(settings):
+    feature_extractor = make_feature_extractor()
+    for name, value in settings.items():
+        setattr(feature_extractor, name, value)
+    with pytest.raises(ValueError):
+        LogMelFrontend(feature_extractor)
+
+def encode_clip(duration, audio_format, sample_rate=8000):
+    wav = np.random.default_rng(0).uniform(-0.5, 0.5, int(duration * sample_rate)).astype(np.float32)
+    audio = io.BytesIO()
+    sf.write(audio, wav, sample_rate, format=audio_format, subtype="PCM_16")
+    return audio.getvalue()
+
+def serve(body, honour_range=True, total=None):
+    """Mocks the pooled session's get with a server holding body; returns the mocked get."""
+    def get(url, headers=None, **kwargs):
+        response = MagicMock()
+        response.__enter__.return_value = response
+        if headers and honour_range:
+            end = int(headers["Range"].rpartition("-")[2])
+            response.status_code = 206
+            response.headers = {"Content-Range": f"bytes 0-{end}/{total or len(body)}"}
+            chunk = body[:end + 1]
+        else:
+            response.status_code = 200
+            response.headers = {}
+            chunk = body
+        response.iter_content.return_value = [chunk]
+        return response
+    session = MagicMock()
+    session.get.side_effect = get
+    return patch("vector_worker.get_http_session", return_value=session), session.get
+
+def fetch(body, prefix_bytes, **server):
+    patcher, get = serve(body, **server)
+    with patcher, patch("vector_worker.AUDIO_PREFIX_BYTES", prefix_bytes):
+        result = fetch_audio("https://example.com/clip")
+    # headers of each request: the ranged prefix, then None for a full refetch
+    return result, [call.kwargs["headers"] for call in get.call_args_list]
+
+def test_fetch_audio_refetches_short_prefix():
+    body = encode_clip(MAX_DURATION + 2, "WAV")
+    (wav, sample_rate), requests = fetch(body, prefix_bytes=64 * 1024)
+    assert requests == [{"Range": f"bytes=0-{64 * 1024 - 1}"}, None]
+    assert len(wav) == MAX_DURATION * sample_rate
+
+def test_fetch_audio_refetches_undecodable_prefix():
+    body = encode_clip(5, "FLAC")
+    (wav, sample_rate), requests = fetch(body, prefix_bytes=20)
+    assert requests[1] is None
+    assert len(wav) == 5 * sample_rate
+
+def test_fetch_audio_accepts_full_response_to_range_request():
+    body = encode_clip(5, "WAV")
+    (wav, sample_rate), requests = fetch(body, prefix_bytes=64 * 1024, honour_range=False)
+    assert len(requests) == 1
+    assert len(wav) == 5 * sample_rate
+
+def test_fetch_audio_treats_unknown_total_as_truncated():
+    body = encode_clip(MAX_DURATION + 2, "WAV")
+    (wav, sample_rate), requests = fetch(body, prefix_bytes=64 * 1024, total="*")
+    assert requests[1] is None
+    assert len(wav) == MAX_DURATION * sample_rate
+
+ALL_FORMATS = {"WAV", "FLAC", "OGG", "MP3"}
+
+HEADERS = [
+    (b"ID3\x04\x00\x00\x00\x00\x00\x21", "MP3"),
+    (b"\xff\xfb\x90\x64\x00\x00", "MP3"),
+    (b"RIFF\x24\x08\x00\x00WAVE", "WAV"),
+    (b"OggS\x00\x02\x00\x00", "OGG"),
+    (b"fLaC\x00\x00\x00\x22", "FLAC"),
+    (b"\x00\x00\x00\x20ftypM4A ", None),
+]
+
+@pytest.mark.parametrize("header, audio_format", HEADERS)
+def test_sniff_format(header, audio_format):
+    with patch("vector_worker.SOUNDFILE_FORMATS", ALL_FORMATS):
+        assert sniff_format(io.BytesIO(header)) == audio_format
+
+@pytest.mark.parametrize("soundfile_formats", [ALL_FORMATS, ALL_FORMATS - {"MP3"}])
+@pytest.mark.parametrize("header, audio_format", HEADERS)
+def test_decode_audio_routes_by_sniffed_format(header, audio_format, soundfile_formats):
+    decoded = (np.zeros(1, dtype=np.float32), 8000)
+    with patch("vector_worker.SOUNDFILE_FORMATS", soundfile_formats), \
+            patch("vector_worker.sf.SoundFile") as soundfile, \
+            patch("vector_worker.decode_with_av", return_value=decoded) as decode_with_av:
+        audio_file = soundfile.return_value.__enter__.return_value
+        audio_file.samplerate = 8000
+        audio_file.read.return_value = np.zeros((1, 1), dtype=np.float32)
+        decode_audio(io.BytesIO(header))
+
+    if audio_format in soundfile_formats:
+        soundfile.assert_called_once()
+        decode_with_av.assert_not_called()
+    else:
+        # Unknown containers, and MP3 on libsndfile builds without it, go straight to PyAV
+        soundfile.assert_not_called()
+        decode_with_av.assert_called_once()